@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+import os, sys, q4pg, json, time, platform, threading
+from datetime import datetime
+from timeit import default_timer as timer
+
+def gettable():
+    return 'bench_table_%s' % str(datetime.now().microsecond).replace(' ', '')
+
+def percentile(samples, p):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100.0))]
+
+def ms(seconds):
+    return (round(seconds * 1000, 3) if seconds is not None else None)
+
+def fill(q, tag, depth, data = None):
+    q.enqueue_many(((tag, data if data is not None else i) for i in range(depth)), chunk_size=10000, copy_threshold=1000)
+    with q.session(None) as (conn, cur):
+        cur.execute("analyze %s;" % q.table_name)
+        conn.commit()
+
+def claim_latency(dsn, strategy, depth, consumers=4, claims=200):
+    q = q4pg.QueueManager(dsn, table_name=gettable(),
+                          claim_strategy=strategy, pool_max_size=consumers)
+    q.create_table()
+    try:
+        fill(q, 'bench', depth + consumers * claims) # keeps depth while claiming.
+        latencies = []
+        lock = threading.Lock()
+        def consume():
+            samples = []
+            for i in range(claims):
+                start = timer()
+                with q.dequeue_item('bench') as dq:
+                    samples.append(timer() - start)
+            with lock:
+                latencies.extend(samples)
+        threads = [threading.Thread(target=consume) for i in range(consumers)]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        return latencies
+    finally:
+        q.drop_table()
+        q.close()
+
+def bench_claim_latency(dsn, depths=(100, 1000, 10000, 100000)):
+    rows = []
+    for depth in depths:
+        for strategy in q4pg.QueueManager.CLAIM_STRATEGIES:
+            samples = claim_latency(dsn, strategy, depth)
+            rows.append(dict(strategy=strategy, depth=depth,
+                             claim_p50_ms=ms(percentile(samples, 50)),
+                             claim_p95_ms=ms(percentile(samples, 95)),
+                             claim_p99_ms=ms(percentile(samples, 99))))
+    return "claim latency with 4 competing consumers", rows
+
+def throughput(dsn, strategy, producers, consumers, size, depth, messages):
+    # producers enqueue `messages` items while consumers drain them and a backlog of `depth` items queued before.
+    tag = 'bench'
+    q = q4pg.QueueManager(dsn, table_name=gettable(), claim_strategy=strategy, content_type='text',
+                          pool_max_size=producers + consumers)
+    q.create_table()
+    try:
+        if depth:
+            fill(q, tag, depth, {'sent': None, 'pad': 'x' * size})
+        lock      = threading.Lock()
+        total     = depth + messages
+        done      = threading.Event()
+        handled   = [0]
+        enqueues, claims, latencies = [], [], []
+        def produce(n):
+            samples = []
+            try:
+                for i in range(n):
+                    start = timer()
+                    q.enqueue(tag, {'sent': time.time(), 'pad': 'x' * size})
+                    samples.append(timer() - start)
+            except:
+                done.set() # not to wait for the messages forever.
+                raise
+            with lock:
+                enqueues.extend(samples)
+        def consume():
+            # claims like a worker: scans while queues are ready, otherwise sleeps until notified.
+            claimed, e2e = [], []
+            wakeup   = q4pg.Wakeup()
+            listener = q.listener([tag])
+            listener.ensure(None)
+            try:
+                while not done.is_set():
+                    start = timer()
+                    with q.dequeue_item(tag) as res:
+                        if res:
+                            claimed.append(timer() - start)
+                            sent = q.deserializer(res[2])['sent']
+                            if sent is not None:
+                                e2e.append(time.time() - sent)
+                    if res:
+                        with lock:
+                            handled[0] += 1
+                            if total <= handled[0]:
+                                done.set()
+                    else:
+                        q.wait_queues(listener, {tag.lower(): tag}, wakeup, time.time() + 0.1)
+            finally:
+                listener.close()
+            with lock:
+                claims.extend(claimed)
+                latencies.extend(e2e)
+        threads = ([threading.Thread(target=consume) for i in range(consumers)] +
+                   [threading.Thread(target=produce, args=(messages // producers + (1 if i < messages % producers else 0),))
+                    for i in range(producers)])
+        start = timer()
+        for t in threads: t.start()
+        for t in threads: t.join()
+        elapsed = timer() - start
+        return dict(strategy=strategy, producers=producers, consumers=consumers, size=size, depth=depth,
+                    messages=messages, seconds=round(elapsed, 3),
+                    msgs_per_sec=round(total / elapsed, 1),
+                    enqueue_p50_ms=ms(percentile(enqueues, 50)),
+                    claim_p50_ms=ms(percentile(claims, 50)),
+                    claim_p95_ms=ms(percentile(claims, 95)),
+                    claim_p99_ms=ms(percentile(claims, 99)),
+                    e2e_p50_ms=ms(percentile(latencies, 50)),
+                    e2e_p95_ms=ms(percentile(latencies, 95)),
+                    e2e_p99_ms=ms(percentile(latencies, 99)))
+    finally:
+        q.drop_table()
+        q.close()
+
+def bench_throughput(dsn, producers=(1, 4), consumers=(1, 4), sizes=(100, 4000), depths=(0, 10000), messages=2000):
+    rows = []
+    for strategy in q4pg.QueueManager.CLAIM_STRATEGIES:
+        for depth in depths:
+            for size in sizes:
+                for p in producers:
+                    for c in consumers:
+                        rows.append(throughput(dsn, strategy, p, c, size, depth, messages))
+    return ("throughput (msgs/s over backlog + produced messages) and latency (ms), "
+            "end-to-end is from enqueue to handler of the produced messages"), rows
+
+def backend_cpu(pid):
+    # cpu seconds used by a backend, readable only when the server runs on this host.
+    try:
+        with open('/proc/%d/stat' % pid) as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / float(os.sysconf('SC_CLK_TCK'))
+    except (IOError, OSError, IndexError, ValueError):
+        return None
+
+def statement_cost(dsn, strategy, prepare_statements, n=5000):
+    # enqueue, claim and ack one by one on a single pooled connection.
+    q = q4pg.QueueManager(dsn, table_name=gettable(), claim_strategy=strategy,
+                          pool_max_size=1, prepare_statements=prepare_statements)
+    q.create_table()
+    try:
+        with q.session(None) as (conn, cur):
+            pid = conn.get_backend_pid()
+        for i in range(100): # warms up, and prepares.
+            q.enqueue('bench', i)
+            with q.dequeue('bench') as dq: pass
+        server, client, start = (backend_cpu(pid), time.process_time(), timer())
+        for i in range(n):
+            q.enqueue('bench', i)
+            with q.dequeue('bench') as dq: pass
+        elapsed, client = (timer() - start, time.process_time() - client)
+        server = (backend_cpu(pid) - server if server is not None else None)
+        return dict(strategy=strategy, prepared=prepare_statements, messages=n,
+                    msgs_per_sec=round(n / elapsed, 1),
+                    client_cpu_us=round(client / n * 1000000, 1),
+                    server_cpu_us=(round(server / n * 1000000, 1) if server is not None else None))
+    finally:
+        q.drop_table()
+        q.close()
+
+def bench_prepared(dsn):
+    rows = []
+    for strategy in q4pg.QueueManager.CLAIM_STRATEGIES:
+        for prepare_statements in (False, True):
+            rows.append(statement_cost(dsn, strategy, prepare_statements))
+    return ("prepared statements : cpu per message (enqueue + claim + ack), "
+            "server cpu is measured only on a local server"), rows
+
+def enqueue_latency(dsn, path, n=2000):
+    # 'transaction' is enqueue in a transaction committed after it (begin, insert, commit),
+    # 'autocommit' is enqueue on its own connection (the insert only).
+    q = q4pg.QueueManager(dsn, table_name=gettable(), pool_max_size=1)
+    q.create_table()
+    try:
+        def enqueue(i):
+            if path == 'autocommit':
+                q.enqueue('bench', i)
+            else:
+                with q.session(None, unlock=False) as (conn, cur):
+                    q.enqueue('bench', i, other_sess=cur)
+                    conn.commit()
+        for i in range(100): # warms up, and prepares.
+            enqueue(i)
+        samples = []
+        start = timer()
+        for i in range(n):
+            started = timer()
+            enqueue(i)
+            samples.append(timer() - started)
+        elapsed = timer() - start
+        return dict(path=path, round_trips=(1 if path == 'autocommit' else 3), messages=n,
+                    msgs_per_sec=round(n / elapsed, 1),
+                    enqueue_p50_ms=ms(percentile(samples, 50)),
+                    enqueue_p95_ms=ms(percentile(samples, 95)),
+                    enqueue_p99_ms=ms(percentile(samples, 99)))
+    finally:
+        q.drop_table()
+        q.close()
+
+def bench_enqueue(dsn):
+    rows = [enqueue_latency(dsn, path) for path in ('transaction', 'autocommit')]
+    return "enqueue latency of a single producer, each round-trip adds the network latency to the database", rows
+
+def payload(size):
+    item = {'id': 12345, 'name': 'item-name', 'tags': ['a', 'b', 'c'], 'price': 1.25, 'active': True}
+    return {'kind': 'bench', 'items': [dict(item, id=i) for i in range(max(1, size // 90))]}
+
+def codec_cost(dsn, data_type, content_type, compress_threshold, data, n=1000):
+    q = q4pg.QueueManager(dsn, table_name=gettable(), data_type=data_type,
+                          content_type=content_type, compress_threshold=compress_threshold)
+    start = timer()
+    for i in range(n):
+        content = q.serializer(data)
+    encode = (timer() - start) / n
+    q.create_table()
+    try:
+        q.enqueue_many((('bench', data) for i in range(n)), copy_threshold=None)
+        with q.session(None) as (conn, cur):
+            cur.execute("select content%s, avg(pg_column_size(content)) over () from %s limit 1;" %
+                        ('::text' if content_type == 'jsonb' else '', q.table_name)) # jsonb is decoded by loads() too.
+            content, stored = cur.fetchone()
+        start = timer()
+        for i in range(n):
+            q.deserializer(content)
+        decode = (timer() - start) / n
+        return encode, decode, float(stored)
+    finally:
+        q.drop_table()
+        q.close()
+
+def bench_serializers(dsn, sizes=(200, 8000)):
+    codecs = [('json', 'text', None), ('fastjson', 'text', None),
+              ('json', 'jsonb', None), ('fastjson', 'jsonb', None),
+              ('pickle', 'bytea', None), ('json', 'bytea', 512), ('pickle', 'bytea', 512)]
+    if 'msgpack' in q4pg.SERIALIZERS:
+        codecs[5:5] = [('msgpack', 'bytea', None), ('msgpack', 'bytea', 512)]
+    rows = []
+    for size in sizes:
+        data = payload(size)
+        for data_type, content_type, compress_threshold in codecs:
+            encode, decode, stored = codec_cost(dsn, data_type, content_type, compress_threshold, data)
+            rows.append(dict(data_type=data_type, column=content_type, compress=compress_threshold, size=size,
+                             encode_us=round(encode * 1000000, 2), decode_us=round(decode * 1000000, 2),
+                             stored_bytes=round(stored, 1)))
+    return "serializers : cost per message and bytes on disk (pg_column_size)", rows
+
+BENCHMARKS = { 'claim': bench_claim_latency, 'serializers': bench_serializers, 'throughput': bench_throughput,
+               'prepared': bench_prepared, 'enqueue': bench_enqueue }
+
+def environment(dsn):
+    q = q4pg.QueueManager(dsn, table_name=gettable())
+    try:
+        with q.session(None) as (conn, cur):
+            cur.execute("show server_version;")
+            server_version = cur.fetchone()[0]
+    finally:
+        q.close()
+    return dict(started=datetime.now().isoformat(), python=platform.python_version(),
+                postgresql=server_version, platform=platform.platform())
+
+def print_table(title, rows):
+    print(title)
+    if not rows:
+        return
+    columns = list(rows[0].keys())
+    widths  = [max(len(c), max(len(str(r[c])) for r in rows)) for c in columns]
+    print(' '.join(c.rjust(w) for c, w in zip(columns, widths)))
+    for r in rows:
+        print(' '.join(str(r[c] if r[c] is not None else '-').rjust(w) for c, w in zip(columns, widths)))
+    print('')
+
+def main():
+    args = [a for a in sys.argv[1:] if a != '--json']
+    if len(args) < 1:
+        print('set dsn for first argument.')
+        print('usage: bench.py DSN [--json] [%s ...]' % ' | '.join(sorted(BENCHMARKS)))
+        sys.exit(1)
+    dsn     = args[0]
+    as_json = ('--json' in sys.argv)
+    results = {}
+    for name in (args[1:] or sorted(BENCHMARKS)):
+        title, rows = BENCHMARKS[name](dsn)
+        results[name] = rows
+        if not as_json:
+            print_table(title, rows)
+    if as_json:
+        print(json.dumps(dict(environment=environment(dsn), results=results), indent=2))
+
+if __name__=="__main__":
+    main()
@@ -12,6 +12,7 @@ setup(
     download_url = "",
     keywords = ["db", "queue", "psql"],
     install_requires = ['psycopg2', 'sqlalchemy'],
+    extras_require = {'async': ['asyncpg']},
     classifiers = [
         "Programming Language :: Python",
         "Programming Language :: Python :: 3",
@@ -1,5 +1,5 @@
 #!/usr/bin/env python
-import os, sys, q4pg, time
+import os, sys, q4pg, time, signal, asyncio, threading, multiprocessing, psycopg2
 from datetime import datetime, timedelta
 from multiprocessing import Process
 from multiprocessing.queues import Queue
@@ -349,8 +349,8 @@ def scheduling():
         if s != r[0]:
             raise Exception("failed scheduling 6 " + str(s) + ", " + str(r) + ", " + str(res))
         span = r[1]
-        ideal = (1 if i < 6 else (int(i / 3) + 0.3))
-        if span < (ideal - 0.3) or (ideal + 0.3) < span:
+        ideal = (1 if i < 6 else int(i / 3))
+        if span < (ideal - 0.1) or (ideal + 0.5) < span: # late by far less than a polling interval.
             raise Exception("failed scheduling 7 " + str(ideal) + ", " + str(span))
         i+=1
     print('OK scheduling 3')
@@ -379,6 +379,1066 @@ def enqueue2():
     _0 = q.enqueue('tag', {'float_param': 0.01})
     print('OK enqueue2 2')
 
+def connection_pool():
+    pids = set()
+    for i in range(5):
+        with q.session(None) as (conn, cur):
+            cur.execute("select pg_backend_pid();")
+            pids.add(cur.fetchone()[0])
+    if len(pids) != 1:
+        raise Exception("failed connection_pool 1")
+    else:
+        print('OK connection_pool 1')
+    q.enqueue('tag_pool', {'pool': 1})
+    q.count('tag_pool')
+    with q.session(None) as (conn, cur):
+        cur.execute("select count(*) from pg_locks where locktype = 'advisory' and pid = pg_backend_pid();")
+        if cur.fetchone()[0] != 0:
+            raise Exception("failed connection_pool 2")
+    q.dequeue_immediate('tag_pool')
+    print('OK connection_pool 2')
+    pool = q4pg.ConnectionPool(q.dsn, max_size=1, timeout=0.2)
+    conn = pool.getconn()
+    try:
+        pool.getconn()
+        raise Exception("failed connection_pool 3")
+    except q4pg.PoolTimeout:
+        pass
+    pool.putconn(conn)
+    if pool.getconn() is not conn:
+        raise Exception("failed connection_pool 3")
+    pool.close()
+    print('OK connection_pool 3')
+    pool = q4pg.ConnectionPool(q.dsn, min_size=2, max_size=3)
+    if (pool.size, len(pool.idle)) != (2, 2):
+        raise Exception("failed connection_pool 4")
+    conn = pool.getconn()
+    pid = conn.get_backend_pid()
+    pool.putconn(conn)
+    with q.session(None) as (c, cur): # the server closes a connection just released.
+        cur.execute("select pg_terminate_backend(%s);", (pid,))
+    time.sleep(0.1)
+    conn = pool.getconn()
+    cur = conn.cursor()
+    cur.execute("select pg_backend_pid();")
+    if cur.fetchone()[0] == pid:
+        raise Exception("failed connection_pool 4")
+    pool.putconn(conn)
+    pool.close()
+    print('OK connection_pool 4')
+
+def enqueue_many():
+    s = datetime.now() + timedelta(0, 60)
+    items = [('tag_many', {'i': i}) for i in range(2500)] + [('tag_many2', {'i': 0}, s)]
+    ids = q.enqueue_many(items, chunk_size=1000, copy_threshold=1000)
+    if len(ids) != len(items) or ids != sorted(ids):
+        raise Exception("failed enqueue_many 1")
+    else:
+        print('OK enqueue_many 1')
+    if (q.count('tag_many') != 2500 or
+        q.count('tag_many2') != 0 or
+        q.count('tag_many2', ignore_scheduled = False) != 1):
+        raise Exception("failed enqueue_many 2")
+    else:
+        print('OK enqueue_many 2')
+    for i in range(2500):
+        if q.dequeue_immediate('tag_many') != {'i': i}:
+            raise Exception("failed enqueue_many 3")
+    q.cancel(ids[-1])
+    print('OK enqueue_many 3')
+    # the threshold is of the whole batch, not of each chunk.
+    copied = []
+    q.copy_rows = lambda cur, rows: copied.append(len(rows)) or q4pg.QueueManager.copy_rows(q, cur, rows)
+    try:
+        q.enqueue_many((('tag_many', {'i': i}) for i in range(15)), chunk_size=10, copy_threshold=15)
+        q.enqueue_many([('tag_many', {'i': i}) for i in range(14)], chunk_size=10, copy_threshold=15)
+    finally:
+        del q.copy_rows
+    if copied != [10, 5] or q.count('tag_many') != 29:
+        raise Exception("failed enqueue_many 4 " + str(copied))
+    for i in range(29):
+        q.dequeue_immediate('tag_many')
+    print('OK enqueue_many 4')
+    # tags with "-" and "+" are notified too.
+    if len(q.enqueue_many([('tag-many+x', {'i': 0})])) != 1 or q.dequeue_immediate('tag-many+x') != {'i': 0}:
+        raise Exception("failed enqueue_many 5")
+    print('OK enqueue_many 5')
+
+def dequeue_batch():
+    q.excepted_times_to_ignore = 0
+    q.enqueue_many([('tag_batch', {'i': i}) for i in range(5)])
+    with q.dequeue_batch('tag_batch', 3) as dq:
+        if dq != [{'i': 0}, {'i': 1}, {'i': 2}]:
+            raise Exception("failed dequeue_batch 1")
+    if q.count('tag_batch') != 2:
+        raise Exception("failed dequeue_batch 1")
+    else:
+        print('OK dequeue_batch 1')
+    try:
+        with q.dequeue_batch('tag_batch', 3) as dq:
+            x = ( 1 / 0 )                     # <= Error
+    except ZeroDivisionError:
+        pass
+    if [i[4] for i in q.list('tag_batch')] != [1, 1]:
+        raise Exception("failed dequeue_batch 2")
+    else:
+        print('OK dequeue_batch 2')
+    res = []
+    for dq in q.listen_batch('tag_batch', 10, max_wait=1):
+        res.append(dq)
+        if dq == None:
+            break
+    if res != [[{'i': 3}, {'i': 4}], None] or q.count('tag_batch') != 0:
+        raise Exception("failed dequeue_batch 3")
+    else:
+        print('OK dequeue_batch 3')
+
+def skip_locked_strategy():
+    sq = q4pg.QueueManager(q.dsn, table_name=gettable(), claim_strategy='skip_locked')
+    sq.create_table()
+    try:
+        ids = sq.enqueue_many([('tag', {'i': i}) for i in range(3)])
+        with sq.dequeue('tag') as dq0:
+            with sq.dequeue('tag') as dq1:
+                if (dq0 != {'i': 0} or dq1 != {'i': 1} or
+                    sq.count('tag') != 1 or sq.cancel(ids[0])):
+                    raise Exception("failed skip_locked_strategy 1")
+        if sq.count('tag') != 1:
+            raise Exception("failed skip_locked_strategy 1")
+        else:
+            print('OK skip_locked_strategy 1')
+        try:
+            with sq.dequeue('tag') as dq:
+                x = ( 1 / 0 )                 # <= Error
+        except ZeroDivisionError:
+            pass
+        if sq.list('tag')[0][4] != 1 or not sq.cancel(ids[2]) or sq.count('tag') != 0:
+            raise Exception("failed skip_locked_strategy 2")
+        else:
+            print('OK skip_locked_strategy 2')
+    finally:
+        sq.drop_table()
+        sq.close()
+
+def persistent_listener():
+    listener = q.listener(['tag_listener'])
+    if listener.wait(0.1) != None or listener.wait(0.1) != []: # connects at first.
+        raise Exception("failed persistent_listener 1")
+    q.enqueue_many([('tag_listener', {'i': i}) for i in range(3)], chunk_size=1)
+    time.sleep(0.1)
+    if len(listener.wait(1)) != 3 or listener.wait(0.1) != []:
+        raise Exception("failed persistent_listener 1")
+    else:
+        print('OK persistent_listener 1')
+    with q.session(None) as (conn, cur):
+        cur.execute("select pg_terminate_backend(%s);", (listener.conn.get_backend_pid(),))
+    time.sleep(0.1)
+    if listener.wait(0.1) != None or listener.wait(0.1) != None: # detects the disconnection and reconnects.
+        raise Exception("failed persistent_listener 2")
+    q.enqueue('tag_listener', {'i': 3})
+    if len(listener.wait(1)) != 1:
+        raise Exception("failed persistent_listener 2")
+    listener.close()
+    res = []
+    for dq in q.listen('tag_listener', timeout=0.5):
+        if dq == None: break
+        res.append(dq)
+    if res != [{'i': i} for i in range(4)]:
+        raise Exception("failed persistent_listener 2")
+    else:
+        print('OK persistent_listener 2')
+
+def listen_many():
+    q.enqueue_many([('tag_many_a', {'i': i}) for i in range(6)] +
+                   [('tag_many_b', {'i': i}) for i in range(2)])
+    res = []
+    for dq in q.listen_many(['tag_many_a', 'tag_many_b'], weights={'tag_many_a': 2}, timeout=0.5):
+        if dq == None: break
+        res.append(dq)
+    if [r[0][-1] for r in res] != ['a', 'b', 'a', 'a', 'b', 'a', 'a', 'a']:
+        raise Exception("failed listen_many 1")
+    else:
+        print('OK listen_many 1')
+    if ([r[1] for r in res if r[0] == 'tag_many_a'] != [{'i': i} for i in range(6)] or
+        [r[1] for r in res if r[0] == 'tag_many_b'] != [{'i': i} for i in range(2)]):
+        raise Exception("failed listen_many 2")
+    else:
+        print('OK listen_many 2')
+    q.enqueue('tag_many_a', {'i': 6})
+    res = []
+    for dq in q.listen_many(['tag_many_a', 'tag_many_b'], timeout=2):
+        if dq == None: break
+        res.append(dq)
+        if len(res) == 1:
+            q.enqueue('tag_many_b', {'i': 2})
+    if res != [('tag_many_a', {'i': 6}), ('tag_many_b', {'i': 2})]:
+        raise Exception("failed listen_many 3")
+    else:
+        print('OK listen_many 3')
+    # tags with "-", "+" and upper cases are listened and waken by their notifications.
+    def enqueue_later():
+        time.sleep(0.3)
+        q.enqueue_many([('Tag-Many+C', {'i': 0})])
+    threading.Thread(target=enqueue_later).start()
+    before = datetime.now()
+    for dq in q.listen_many(['tag_many_a', 'Tag-Many+C'], timeout=5):
+        break
+    if dq != ('Tag-Many+C', {'i': 0}) or 1 < getspan(before):
+        raise Exception("failed listen_many 4 " + str(dq))
+    print('OK listen_many 4')
+
+def async_queue_manager():
+    if q4pg.asyncpg is None:
+        print('SKIP async_queue_manager (asyncpg is not installed)')
+        return
+    async def run():
+        async with q4pg.AsyncQueueManager(q.dsn, table_name=q.table_name) as aq:
+            ids = [await aq.enqueue('tag_async', {'i': i}) for i in range(3)]
+            if await aq.count('tag_async') != 3:
+                raise Exception("failed async_queue_manager 1")
+            async with aq.dequeue('tag_async') as dq:
+                if dq != {'i': 0}:
+                    raise Exception("failed async_queue_manager 1")
+            try:
+                async with aq.dequeue('tag_async') as dq:
+                    x = ( 1 / 0 )             # <= Error
+            except ZeroDivisionError:
+                pass
+            if q.list('tag_async')[-1][4] != 1 or not await aq.cancel(ids[2]):
+                raise Exception("failed async_queue_manager 1")
+            print('OK async_queue_manager 1')
+            for i in range(3, 50):
+                await aq.enqueue('tag_async', {'i': i})
+            res = []
+            async def consume():
+                async for dq in aq.listen('tag_async', timeout=0.5):
+                    if dq == None: break
+                    res.append(dq['i'])
+                    await asyncio.sleep(0.01)
+            consumer = asyncio.gather(*[consume() for i in range(8)])
+            await asyncio.sleep(0.2)
+            # the consumers share one LISTEN connection.
+            if len(aq.consumers.get('tag_async', [])) != 8 or aq.listen_conn is None:
+                raise Exception("failed async_queue_manager 2")
+            await aq.enqueue('tag_async', {'i': 50})
+            await consumer
+            await asyncio.sleep(0.1) # the listen() left by break are closed by the loop.
+            if sorted(res) != [1] + list(range(3, 51)) or await aq.count('tag_async') != 0 or aq.consumers != {}:
+                raise Exception("failed async_queue_manager 2")
+            print('OK async_queue_manager 2')
+            # the shared connection is lost, the consumers listen again on a new one.
+            res = []
+            async def consume_timed():
+                async for dq in aq.listen('tag_async', timeout=2):
+                    if dq == None: break
+                    res.append((dq['i'], time.time()))
+            consumer = asyncio.gather(*[consume_timed() for i in range(2)])
+            await asyncio.sleep(0.2)
+            with q.session(None) as (conn, cur):
+                cur.execute("select pg_terminate_backend(%s);", (aq.listen_conn.get_server_pid(),))
+                conn.commit()
+            await asyncio.sleep(0.2)
+            started = time.time()
+            await aq.enqueue('tag_async', {'i': 51})
+            await aq.enqueue('tag_async', {'i': 52})
+            await consumer
+            await asyncio.sleep(0.1)
+            if sorted(r[0] for r in res) != [51, 52] or 1 < max(r[1] for r in res) - started or aq.consumers != {}:
+                raise Exception("failed async_queue_manager 3 " + str(res))
+            print('OK async_queue_manager 3')
+    asyncio.run(run())
+
+def worker():
+    q.excepted_times_to_ignore = 0
+    q.enqueue_many([('tag_worker', {'i': i}) for i in range(20)])
+    res, attempts = [], {}
+    def handler(dq):
+        attempts[dq['i']] = attempts.get(dq['i'], 0) + 1
+        if dq['i'] == 5 and attempts[5] == 1:
+            x = ( 1 / 0 )                     # <= Error
+        res.append(dq['i'])
+    w = q4pg.Worker(q, 'tag_worker', handler, concurrency=4, prefetch=3)
+    t = threading.Thread(target=w.run)
+    t.start()
+    while len(res) < 20 and t.is_alive():
+        time.sleep(0.05)
+    w.stop()
+    t.join()
+    if sorted(res) != list(range(20)) or attempts[5] != 2 or q.count('tag_worker') != 0:
+        raise Exception("failed worker 1")
+    else:
+        print('OK worker 1')
+    q.enqueue_many([('tag_worker', {'i': i}) for i in range(20)])
+    done, res = multiprocessing.Queue(), []
+    def stop_when_done():
+        try:
+            while len(res) < 20:
+                res.append(done.get(timeout=10))
+        finally:
+            os.kill(os.getpid(), signal.SIGTERM)
+    threading.Thread(target=stop_when_done).start()
+    q.run_workers('tag_worker', lambda dq: done.put((os.getpid(), dq['i'])), concurrency=2, mode='process', prefetch=2)
+    pids = set(r[0] for r in res)
+    if sorted(r[1] for r in res) != list(range(20)) or os.getpid() in pids or not (1 <= len(pids) <= 2):
+        raise Exception("failed worker 2 " + str(res))
+    else:
+        print('OK worker 2')
+    # the backend of the claim is terminated while handling, the worker survives and claims it again.
+    q.enqueue_many([('tag_worker', {'i': i}) for i in range(5)])
+    res = []
+    def handler(dq):
+        if not res:
+            with q.session(None) as (conn, cur):
+                cur.execute("select pg_terminate_backend(pid) from pg_locks where locktype = 'advisory' and pid <> pg_backend_pid();")
+                conn.commit()
+        res.append(dq['i'])
+    w = q4pg.Worker(q, 'tag_worker', handler)
+    t = threading.Thread(target=w.run)
+    t.start()
+    while q.count('tag_worker') != 0 and t.is_alive():
+        time.sleep(0.05)
+    w.stop()
+    t.join()
+    if sorted(set(res)) != list(range(5)) or res.count(0) != 2 or q.get_metrics()['counters'].get('worker_errors') != 1:
+        raise Exception("failed worker 3 " + str(res))
+    else:
+        print('OK worker 3')
+    try:
+        q4pg.Worker(q, 'tag_worker', handler, concurrency=q.pool.max_size + 1)
+        raise Exception("failed worker 4")
+    except ValueError:
+        print('OK worker 4')
+
+def stats():
+    s = datetime.now() + timedelta(0, 60)
+    ids = q.enqueue_many([('tag_stats', {'i': i}) for i in range(4)] + [('tag_stats', {'i': 4}, s)])
+    try:
+        with q.dequeue('tag_stats') as dq:
+            x = ( 1 / 0 )                     # <= Error
+    except ZeroDivisionError:
+        pass
+    with q.dequeue('tag_stats') as dq:
+        st = q.stats(['tag_stats', 'tag_stats_none'])
+        if (st['tag_stats'] != dict(ready=3, scheduled=1, in_flight=1, failed=1, total=5) or
+            st['tag_stats_none'] != dict(ready=0, scheduled=0, in_flight=0, failed=0, total=0)):
+            raise Exception("failed stats 1 " + str(st))
+        with q.session(None) as (conn, cur):
+            cur.execute("select count(*) from pg_locks where locktype = 'advisory' and pid = pg_backend_pid();")
+            if cur.fetchone()[0] != 0:
+                raise Exception("failed stats 1")
+    if q.stats()['tag_stats']['total'] != 4:
+        raise Exception("failed stats 1")
+    else:
+        print('OK stats 1')
+    with q.session(None) as (conn, cur):
+        cur.execute("analyze %s;" % q.table_name)
+        conn.commit()
+    st = q.stats(['tag_stats'], approximate=True)['tag_stats']
+    if (sorted(st) != ['failed', 'ready', 'scheduled', 'total'] or st['total'] != 4 or
+        st['ready'] + st['scheduled'] != 4 or not (0 <= st['failed'] <= 4)):
+        raise Exception("failed stats 2 " + str(st))
+    # tags not in the statistics (e.g. enqueued since the last analyze) are estimated too.
+    id = q.enqueue('tag_stats_new', 'a')
+    st = q.stats(approximate=True)
+    if st.get('tag_stats', {}).get('total') != 4 or st.get('tag_stats_new', {}).get('total', 0) < 1:
+        raise Exception("failed stats 2 " + str(st))
+    else:
+        print('OK stats 2')
+    q.cancel(id)
+    for id in ids: q.cancel(id)
+
+def iter_items():
+    now = datetime.now()
+    ids = q.enqueue_many([('tag_iter', {'i': i}) for i in range(25)] +
+                         [('tag_iter', {'i': 25}, now + timedelta(0, 60))])
+    res = list(q.iter_items('tag_iter', batch_size=10))
+    if [r[0] for r in res] != ids:
+        raise Exception("failed iter_items 1")
+    else:
+        print('OK iter_items 1')
+    if ([r[0] for r in q.iter_items('tag_iter', batch_size=10, after_id=ids[19])] != ids[20:] or
+        [r[0] for r in q.iter_items('tag_iter', scheduled_after=now)] != ids[25:] or
+        list(q.iter_items('tag_iter', created_before=now - timedelta(0, 60))) != []):
+        raise Exception("failed iter_items 2")
+    else:
+        print('OK iter_items 2')
+    for id in ids: q.cancel(id)
+
+def serializers():
+    data = {'text': 'x' * 2000, 'list': list(range(10)), 'nested': {'a': None}}
+    for data_type, content_type, compress_threshold in (('json', 'text', None),
+                                                       ('fastjson', 'jsonb', None),
+                                                       ('pickle', 'bytea', None),
+                                                       ('json', 'bytea', 100)):
+        sq = q4pg.QueueManager(q.dsn, table_name=gettable(), data_type=data_type,
+                               content_type=content_type, compress_threshold=compress_threshold)
+        sq.create_table()
+        try:
+            sq.enqueue('tag', data)
+            sq.enqueue_many([('tag', data)] * 2, copy_threshold=2)
+            for i in range(3):
+                with sq.dequeue('tag') as dq:
+                    if dq != data:
+                        raise Exception("failed serializers 1 (%s, %s)" % (data_type, content_type))
+            if compress_threshold:
+                sq.enqueue('tag', data)
+                if len(bytes(sq.list('tag')[0][2])) > 200:
+                    raise Exception("failed serializers 2")
+                print('OK serializers 2')
+            if content_type == 'jsonb':
+                # strings are stored as json strings, not decoded twice.
+                sq.enqueue_many([('tag', 'hello'), ('tag', '{"a": 1}')])
+                if [sq.dequeue_immediate('tag'), sq.dequeue_immediate('tag')] != ['hello', '{"a": 1}']:
+                    raise Exception("failed serializers 4")
+                print('OK serializers 4')
+        finally:
+            sq.drop_table()
+            sq.close()
+    print('OK serializers 1')
+    try:
+        q4pg.QueueManager(q.dsn, data_type='pickle')
+        raise Exception("failed serializers 3")
+    except ValueError:
+        print('OK serializers 3')
+
+def scheduled_delivery():
+    q.excepted_times_to_ignore = 0
+    def enqueue_later():
+        time.sleep(0.2)
+        q.enqueue('tag_sched', {'i': 0}, schedule = datetime.now() + timedelta(0, 0.5))
+    threading.Thread(target=enqueue_later).start()
+    before = datetime.now()
+    for dq in q.listen('tag_sched', timeout=3): # waken by the notification of the schedule, not by polling.
+        span = getspan(before)
+        if dq != {'i': 0} or span < 0.7 or 0.9 < span:
+            raise Exception("failed scheduled_delivery 1 " + str(span))
+        break
+    print('OK scheduled_delivery 1')
+    q.enqueue('tag_sched2', {'i': 1})
+    res = []
+    def consume():
+        for dq in q.listen('tag_sched2', timeout=2):
+            res.append((dq, getspan(before)))
+            break
+    t = threading.Thread(target=consume)
+    try:
+        with q.dequeue('tag_sched2') as dq:
+            t.start()
+            time.sleep(0.3)
+            before = datetime.now()
+            x = ( 1 / 0 )                     # <= Error (reported and notified)
+    except ZeroDivisionError:
+        pass
+    t.join()
+    if res[0][0] != {'i': 1} or 0.5 < res[0][1]:
+        raise Exception("failed scheduled_delivery 2 " + str(res))
+    else:
+        print('OK scheduled_delivery 2')
+
+def metrics():
+    class Observer(object):
+        def __init__(self):
+            self.names = set()
+        def incr(self, name, n = 1):
+            self.names.add(name)
+        def observe(self, name, seconds):
+            self.names.add(name)
+    observer = Observer()
+    mq = q4pg.QueueManager(q.dsn, table_name=gettable(), observers=[observer])
+    mq.create_table()
+    try:
+        mq.enqueue('tag', {'i': 0})
+        with mq.dequeue('tag') as dq:
+            pass
+        with mq.dequeue('tag') as dq:         # empty claim
+            pass
+        mq.enqueue('tag', {'i': 1})
+        try:
+            with mq.dequeue('tag') as dq:
+                x = ( 1 / 0 )                 # <= Error (retried)
+        except ZeroDivisionError:
+            pass
+        m = mq.get_metrics()
+        c, h = (m['counters'], m['histograms'])
+        if (c['enqueued'] != 2 or c['claims'] != 3 or c['claims_empty'] != 1 or c['claimed'] != 2 or
+            c['acked'] != 1 or c['retries'] != 1 or m['empty_claim_rate'] != 1 / 3.0):
+            raise Exception("failed metrics 1 " + str(c))
+        if (h['claim']['count'] != 3 or h['ack']['count'] != 1 or h['handle']['count'] != 1 or
+            h['connect']['count'] < 5 or not (0 < h['claim']['p50'] <= h['claim']['max'])):
+            raise Exception("failed metrics 1 " + str(h))
+        if not (set(['claim', 'ack', 'enqueue', 'report', 'connect', 'session', 'retries']) <= observer.names):
+            raise Exception("failed metrics 1 " + str(observer.names))
+        print('OK metrics 1')
+        with mq.dequeue('tag') as dq:
+            pass
+        mq.metrics.reset()
+        got = []
+        def consume():
+            for dq in mq.listen('tag', timeout=0.6):
+                if dq is None:
+                    break
+                got.append(dq)
+        threads = [threading.Thread(target=consume) for i in range(2)]
+        for t in threads: t.start()
+        time.sleep(0.3)
+        mq.enqueue('tag', {'i': 2})           # wakes up both, one of them is wasted.
+        for t in threads: t.join()
+        c = mq.get_metrics()['counters']
+        if got != [{'i': 2}] or c['notifications_received'] < 2 or c['notifications_wasted'] != 1:
+            raise Exception("failed metrics 2 " + str(c))
+        print('OK metrics 2')
+    finally:
+        mq.drop_table()
+        mq.close()
+
+def partitions():
+    for claim_strategy in q4pg.QueueManager.CLAIM_STRATEGIES:
+        pq = q4pg.QueueManager(q.dsn, table_name=gettable(), claim_strategy=claim_strategy,
+                               partitions=3, partition_size=4)
+        pq.create_table()
+        try:
+            p0, p1, p2 = [p for (p, lower, upper) in pq.partition_ranges()]
+            ids = pq.enqueue_many([('tag', i) for i in range(6)])  # => p0 (1-4), p1 (5-6)
+            if ids != [1, 2, 3, 4, 5, 6] or pq.count('tag') != 6:
+                raise Exception("failed partitions 1 " + str(ids))
+            if not pq.cancel(5):                                 # across partitions
+                raise Exception("failed partitions 1")
+            for i in range(4):
+                with pq.dequeue('tag') as dq:
+                    if dq != i:
+                        raise Exception("failed partitions 1 " + str(dq))
+            print('OK partitions 1')
+            if pq.rotate_partitions() != [p0]:                   # p0 is drained, p1 is current.
+                raise Exception("failed partitions 2")
+            if pq.rotate_partitions() != []:
+                raise Exception("failed partitions 2")
+            print('OK partitions 2')
+            ids = pq.enqueue_many([('tag', i) for i in range(6, 14)]) # ids cycle into the truncated p0.
+            if ids != [7, 8, 9, 10, 11, 12, 1, 2] or pq.count('tag') != 9:
+                raise Exception("failed partitions 3 " + str(ids))
+            res = [pq.dequeue_immediate('tag') for i in range(9)]
+            if res != [12, 13, 5, 6, 7, 8, 9, 10, 11]:           # claimed in order of id, the wrapped ids first.
+                raise Exception("failed partitions 3 " + str(res))
+            if pq.rotate_partitions() != [p1, p2]:
+                raise Exception("failed partitions 3")
+            print('OK partitions 3')
+        finally:
+            pq.drop_table()
+            pq.close()
+
+def prepared_statements():
+    for prepare_statements in (True, False):
+        pq = q4pg.QueueManager(q.dsn, table_name=gettable(), pool_max_size=1,
+                               prepare_statements=prepare_statements)
+        pq.create_table()
+        try:
+            for i in range(3):
+                pq.enqueue('tag', {'i': i})
+                with pq.dequeue('tag') as dq:
+                    if dq != {'i': i}:
+                        raise Exception("failed prepared_statements 1 " + str(dq))
+            pq.enqueue('tag', {'i': 3})
+            if pq.cancel(pq.list('tag')[0][0]) != True or pq.cancel(0):
+                raise Exception("failed prepared_statements 1")
+            with pq.session(None) as (conn, cur):
+                cur.execute("select name from pg_prepared_statements where name like %s order by name;",
+                            (pq.table_name + '%',))
+                names = [r[0] for r in cur.fetchall()]
+            expected = ([pq.table_name + '_' + key for key in ('ack_sql', 'cancel_sql', 'insert_sql', 'select_sql')]
+                        if prepare_statements else [])
+            if names != expected or pq.get_metrics()['histograms'].get('prepare', {}).get('count', 0) != len(expected):
+                raise Exception("failed prepared_statements 1 " + str(names))
+            print('OK prepared_statements 1')
+            pq.reset_table()                  # prepared statements are re-planned on the new table.
+            pq.enqueue('tag', {'i': 4})
+            if pq.dequeue_immediate('tag') != {'i': 4}:
+                raise Exception("failed prepared_statements 2")
+            print('OK prepared_statements 2')
+            if prepare_statements:
+                with pq.session(None) as (conn, cur):
+                    cur.execute("deallocate all;") # as if the server session changed.
+                    conn.commit()
+                pq.enqueue('tag', {'i': 5}) # prepared again, and retried.
+                if pq.dequeue_immediate('tag') != {'i': 5} or q4pg.QueueManager(q.dsn).prepare_statements:
+                    raise Exception("failed prepared_statements 3")
+                print('OK prepared_statements 3')
+        finally:
+            pq.drop_table()
+            pq.close()
+
+def dead_letter():
+    for claim_strategy in q4pg.QueueManager.CLAIM_STRATEGIES:
+        dq = q4pg.QueueManager(q.dsn, table_name=gettable(), claim_strategy=claim_strategy,
+                               excepted_times_to_ignore=3, retry_delay=0.2, dead_letter=True)
+        dq.create_table()
+        try:
+            ids = dq.enqueue_many([('tag', {'i': 0}), ('tag', {'i': 1})])
+            for delay in (0.2, 0.4, None):
+                try:
+                    with dq.dequeue_batch('tag', 2) as items:
+                        if len(items) != 2:
+                            raise Exception("failed dead_letter 1 " + str(items))
+                        x = ( 1 / 0 )         # <= Error (retried later)
+                except ZeroDivisionError:
+                    pass
+                if delay is None:
+                    break
+                res = dq.list('tag', ignore_scheduled=False)
+                span = (res[0][5] - datetime.now()).total_seconds()
+                if len(res) != 2 or not (delay - 0.1 < span <= delay) or dq.dequeue_immediate('tag') != None:
+                    raise Exception("failed dead_letter 1 " + str(res))
+                time.sleep(delay + 0.05)
+            print('OK dead_letter 1')
+            dead = dq.list_dead('tag')
+            if (dq.list('tag', ignore_scheduled=False) != [] or [r[0] for r in dead] != ids or
+                [r[4] for r in dead] != [3, 3] or dq.get_metrics()['counters']['dead'] != 2):
+                raise Exception("failed dead_letter 2 " + str(dead))
+            print('OK dead_letter 2')
+            if dq.requeue_dead('tag', died_before=datetime.now() - timedelta(0, 60)) != []:
+                raise Exception("failed dead_letter 3")
+            new_ids = dq.requeue_dead('tag', ids=ids[:1])
+            res = dq.list('tag')
+            if len(new_ids) != 1 or [(r[0], r[4], r[5]) for r in res] != [(new_ids[0], 0, None)]:
+                raise Exception("failed dead_letter 3 " + str(res))
+            if dq.dequeue_immediate('tag') != {'i': 0}:
+                raise Exception("failed dead_letter 3")
+            if dq.purge_dead('tag') != 1 or dq.list_dead('tag') != []:
+                raise Exception("failed dead_letter 3")
+            print('OK dead_letter 3')
+        finally:
+            dq.drop_table()
+            dq.close()
+    try:
+        q4pg.QueueManager(q.dsn, dead_letter=True)
+        raise Exception("failed dead_letter 4")
+    except ValueError:
+        print('OK dead_letter 4')
+
+def notify_payloads():
+    parse = q4pg.Wakeup.parse
+    if (parse('12,') != (12, None) or parse('12,1760000000.5') != (12, 1760000000.5) or
+        parse(',1760000000.5') != (None, 1760000000.5) or parse('1760000000.5') != (None, 1760000000.5) or
+        parse('') != (None, None)):
+        raise Exception("failed notify_payloads 1")
+    print('OK notify_payloads 1')
+    nq = q4pg.QueueManager(q.dsn, table_name=gettable())
+    nq.create_table()
+    try:
+        got = []
+        def consume():
+            for dq in nq.listen('tag', timeout=0.5):
+                if dq is None:
+                    break
+                got.append(dq)
+        t = threading.Thread(target=consume)
+        t.start()
+        time.sleep(0.2)
+        for i in range(5):
+            nq.enqueue('tag', {'i': i})       # a burst, claimed by the notified ids.
+        t.join()
+        c = nq.get_metrics()['counters']
+        if (got != [{'i': i} for i in range(5)] or c['claims_by_id'] != 5 or
+            c['claims'] - c['claimed'] != 1):  # only the first scan is empty.
+            raise Exception("failed notify_payloads 2 " + str(c))
+        print('OK notify_payloads 2')
+        nq.enqueue_many([('tag', {'i': i}) for i in range(5, 8)])
+        schedule = datetime.now() + timedelta(0, 0.3)
+        nq.enqueue('tag', {'i': 8}, schedule = schedule)
+        got = []
+        for dq in nq.listen('tag', timeout=1):
+            if dq is None:
+                break
+            got.append((dq, getspan(schedule)))
+        if [g[0] for g in got] != [{'i': i} for i in range(5, 9)] or not (0 <= got[-1][1] < 0.05):
+            raise Exception("failed notify_payloads 3 " + str(got))
+        print('OK notify_payloads 3')
+    finally:
+        nq.drop_table()
+        nq.close()
+
+def shared_manager():
+    sq = q4pg.QueueManager(q.dsn, table_name=gettable(), pool_max_size=8)
+    sq.create_table()
+    try:
+        sq.enqueue_many([('tag', {'i': i, 'fail': (i % 2 == 0)}) for i in range(200)])
+        done = {}
+        def consume():
+            while True:
+                try:
+                    with sq.dequeue_item('tag') as res:
+                        if res is None:
+                            return
+                        data = sq.deserializer(res[2])
+                        time.sleep(0.001)
+                        if data['fail'] and res[4] == 0:
+                            raise ValueError(data['i'])   # <= Error (reported against this queue only)
+                        done[data['i']] = res[4]
+                except ValueError:
+                    pass
+        threads = [threading.Thread(target=consume) for i in range(8)]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        consume() # the rest reported while others were finishing.
+        if sorted(done) != list(range(200)) or [i for i, times in done.items() if times != (1 - i % 2)]:
+            raise Exception("failed shared_manager 1 " + str(done))
+        print('OK shared_manager 1')
+    finally:
+        sq.drop_table()
+        sq.close()
+
+def priorities():
+    for claim_strategy in q4pg.QueueManager.CLAIM_STRATEGIES:
+        pq = q4pg.QueueManager(q.dsn, table_name=gettable(), claim_strategy=claim_strategy, priorities=True)
+        pq.create_table()
+        try:
+            pq.enqueue('tag', 'low1')
+            pq.enqueue('tag', 'high1', priority=10)
+            pq.enqueue('tag', 'low2')
+            pq.enqueue('tag', 'high2', priority=10)
+            pq.enqueue('tag', 'urgent', priority=20, schedule=datetime.now() + timedelta(0, 60)) # not ready yet.
+            pq.enqueue_many([('tag', 'mid1', None, 5), ('tag', 'lowest', None, -1), ('tag', 'mid2', None, 5)])
+            res = []
+            while True:
+                data = pq.dequeue_immediate('tag')
+                if data is None:
+                    break
+                res.append(data)
+            if res != ['high1', 'high2', 'mid1', 'mid2', 'low1', 'low2', 'lowest']:
+                raise Exception("failed priorities 1 " + str(res))
+            print('OK priorities 1')
+            pq.enqueue_many([('tag', i, None, i % 3) for i in range(12)], copy_threshold=1)
+            with pq.dequeue_batch('tag', 12) as res:
+                pass
+            if res != [2, 5, 8, 11, 1, 4, 7, 10, 0, 3, 6, 9]:
+                raise Exception("failed priorities 2 " + str(res))
+            print('OK priorities 2')
+        finally:
+            pq.drop_table()
+            pq.close()
+    for priority in (1.5, 40000):
+        try:
+            pq.check_priority(priority)
+            raise Exception("failed priorities 3")
+        except ValueError:
+            pass
+    try:
+        q.enqueue('tag', 'x', priority=1)
+        raise Exception("failed priorities 3")
+    except ValueError:
+        print('OK priorities 3')
+
+def lease():
+    lq = q4pg.QueueManager(q.dsn, table_name=gettable(), claim_strategy='lease', lease_timeout=1,
+                           pool_max_size=1, pool_timeout=2)
+    lq.create_table()
+    try:
+        lq.enqueue('tag', 'a')
+        lq.enqueue('tag', 'b')
+        with lq.dequeue('tag') as a:
+            # the only connection is back in the pool while handling.
+            with lq.dequeue('tag') as b:
+                res = list(lq.iter_items('tag'))
+                owner = "%s:%d:" % (lq.hostname[:20], os.getpid()) # and a token of each claim.
+                if ((a, b) != ('a', 'b') or len(set(r[7] for r in res)) != 2 or
+                    [r[7][:len(owner)] for r in res] != [owner] * 2 or lq.count('tag') != 0):
+                    raise Exception("failed lease 1 " + str(res))
+                time.sleep(1.5) # longer than the lease, kept by heartbeats.
+                if lq.dequeue_immediate('tag') != None or lq.stats(['tag'])['tag']['in_flight'] != 2:
+                    raise Exception("failed lease 1")
+        if lq.stats(['tag'])['tag']['total'] != 0 or lq.get_metrics()['counters']['heartbeats'] < 2:
+            raise Exception("failed lease 1 " + str(lq.get_metrics()['counters']))
+        print('OK lease 1')
+        lq.enqueue('tag', 'c')
+        try:
+            with lq.dequeue('tag') as dq:
+                x = ( 1 / 0 )                     # <= Error
+        except ZeroDivisionError:
+            pass
+        res = lq.list('tag')
+        if [(r[2], r[4], r[6], r[7]) for r in res] != [('"c"', 1, None, None)]:
+            raise Exception("failed lease 2 " + str(res))
+        print('OK lease 2')
+        # a worker died without acking, the lease expires and the queue is claimed again as failed once more.
+        if [r[2] for r in lq.claim_leased('tag', 10)] != ['"c"'] or lq.dequeue_immediate('tag') != None:
+            raise Exception("failed lease 3")
+        res = []
+        for dq in lq.listen_item('tag', timeout=3): # waken when the lease expires.
+            res.append(dq)
+            break
+        if len(res) != 1 or res[0][2] != '"c"' or res[0][4] != 2:
+            raise Exception("failed lease 3 " + str(res))
+        if [r[4] for r in lq.list('tag')] != [3] or not lq.cancel(res[0][0]): # reported by the break.
+            raise Exception("failed lease 3")
+        print('OK lease 3')
+        lq.enqueue_many([('tag', {'i': i}) for i in range(10)])
+        rows, others = (lq.claim_leased('tag', 2), lq.claim_leased('tag', 2))
+        # a claim of another thread of the same process does not match the token.
+        if (lq.heartbeat([r[0] for r in others], rows[0][7]) != [] or lq.release([r[0] for r in rows], others[0][7]) != 0 or
+            lq.heartbeat([r[0] for r in others], others[0][7]) != [r[0] for r in others]):
+            raise Exception("failed lease 4")
+        if (lq.release([r[0] for r in rows], rows[0][7]) != 2 or lq.heartbeat([r[0] for r in rows], rows[0][7]) != [] or
+            lq.release([r[0] for r in others], others[0][7]) != 2):
+            raise Exception("failed lease 4")
+        res = []
+        w = q4pg.Worker(lq, 'tag', lambda dq: res.append(dq['i']), concurrency=2, prefetch=3)
+        t = threading.Thread(target=w.run)
+        t.start()
+        while len(res) < 10 and t.is_alive():
+            time.sleep(0.05)
+        w.stop()
+        t.join()
+        if sorted(res) != list(range(10)) or lq.stats(['tag'])['tag']['total'] != 0:
+            raise Exception("failed lease 4 " + str(res))
+        print('OK lease 4')
+    finally:
+        lq.drop_table()
+        lq.close()
+    try:
+        q.heartbeat([1], 'token')
+        raise Exception("failed lease 5")
+    except ValueError:
+        print('OK lease 5')
+    lq = q4pg.QueueManager(q.dsn, table_name=gettable(), claim_strategy='lease', lease_timeout=1,
+                           excepted_times_to_ignore=2, dead_letter=True)
+    lq.create_table()
+    try:
+        # the workers claiming it keep dying, the expired leases count as failures until buried.
+        id = lq.enqueue('tag', 'poison')
+        for i in range(2):
+            if [r[0] for r in lq.claim_leased('tag', 1)] != [id]:
+                raise Exception("failed lease 6")
+            time.sleep(1.2)
+        with lq.dequeue('tag') as dq: # claimed for the third time, buried instead of handled.
+            if dq != None:
+                raise Exception("failed lease 6")
+        if lq.list('tag') != []:
+            raise Exception("failed lease 6")
+        res = lq.list_dead('tag')
+        if [(r[0], r[2], r[4]) for r in res] != [(id, '"poison"', 2)] or lq.get_metrics()['counters']['dead'] != 1:
+            raise Exception("failed lease 6 " + str(res))
+        print('OK lease 6')
+    finally:
+        lq.drop_table()
+        lq.close()
+
+def dedup_keys():
+    for claim_strategy in q4pg.QueueManager.CLAIM_STRATEGIES:
+        dq = q4pg.QueueManager(q.dsn, table_name=gettable(), claim_strategy=claim_strategy, dedup_keys=True)
+        dq.create_table()
+        try:
+            id = dq.enqueue('tag', {'i': 0}, dedup_key='user-1')
+            if (dq.enqueue('tag', {'i': 1}, dedup_key='user-1') != id or dq.enqueue('tag2', {'i': 2}, dedup_key='user-1') == id or
+                dq.enqueue('tag', {'i': 3}) == id or dq.count('tag') != 2):
+                raise Exception("failed dedup_keys 1")
+            counters = dq.get_metrics()['counters']
+            if counters['enqueued'] != 3 or counters['deduplicated'] != 1:
+                raise Exception("failed dedup_keys 1 " + str(counters))
+            print('OK dedup_keys 1')
+            ids = dq.enqueue_many([('tag', {'i': 4}, None, None, 'user-2'), ('tag', {'i': 5}, None, None, 'user-1'),
+                                   ('tag', {'i': 6}), ('tag', {'i': 7}, None, None, 'user-2')], copy_threshold=1)
+            if ids[1] != id or ids[0] != ids[3] or len(set(ids)) != 3 or dq.count('tag') != 4:
+                raise Exception("failed dedup_keys 2 " + str(ids))
+            print('OK dedup_keys 2')
+            # once acked, the key can be queued again.
+            with dq.dequeue('tag') as res:
+                if dq.enqueue('tag', {'i': 8}, dedup_key='user-1') != id: # being handled.
+                    raise Exception("failed dedup_keys 3")
+            if dq.enqueue('tag', {'i': 9}, dedup_key='user-1') == id or dq.count('tag') != 4:
+                raise Exception("failed dedup_keys 3")
+            print('OK dedup_keys 3')
+        finally:
+            dq.drop_table()
+            dq.close()
+    try:
+        q.enqueue('tag', 'x', dedup_key='user-1')
+        raise Exception("failed dedup_keys 4")
+    except ValueError:
+        pass
+    try:
+        q4pg.QueueManager(q.dsn, dedup_keys=True, partitions=2)
+        raise Exception("failed dedup_keys 4")
+    except ValueError:
+        print('OK dedup_keys 4')
+
+def single_round_trip_enqueue():
+    sq = q4pg.QueueManager(q.dsn, table_name=gettable(), pool_max_size=1)
+    sq.create_table()
+    try:
+        id = sq.enqueue('tag', 'a')
+        conn = sq.pool.idle[-1]
+        if (conn.autocommit or conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE or
+            q4pg.QueueManager(q.dsn, table_name=sq.table_name, pool_max_size=0).count('tag') != 1):
+            raise Exception("failed single_round_trip_enqueue 1")
+        print('OK single_round_trip_enqueue 1')
+        try:
+            sq.enqueue('tag', 'x' * 2000) # <= Error (too long for varchar(1023))
+            raise Exception("failed single_round_trip_enqueue 2")
+        except psycopg2.DataError:
+            pass
+        if not (id < sq.enqueue('tag', 'b')) or sq.pool.idle[-1].autocommit or sq.count('tag') != 2:
+            raise Exception("failed single_round_trip_enqueue 2")
+        print('OK single_round_trip_enqueue 2')
+        # in other session, it is a part of the transaction of the session.
+        with sq.session(None) as (conn, cur):
+            sq.enqueue('tag', 'c', other_sess=cur)
+            conn.rollback()
+        if [sq.deserializer(r[2]) for r in sq.list('tag')] != ['a', 'b']:
+            raise Exception("failed single_round_trip_enqueue 3")
+        print('OK single_round_trip_enqueue 3')
+    finally:
+        sq.drop_table()
+        sq.close()
+
+def sharded_queue_manager():
+    keys = ['key-%d' % i for i in range(1000)]
+    ring3, ring4 = (q4pg.HashRing(['a', 'b', 'c']), q4pg.HashRing(['a', 'b', 'c', 'd']))
+    moved = [k for k in keys if ring3.node(k) != ring4.node(k)]
+    if [k for k in moved if ring4.node(k) != 'd'] or not (150 < len(moved) < 350) or len(set(ring3.node(k) for k in keys)) != 3:
+        raise Exception("failed sharded_queue_manager 1 " + str(len(moved)))
+    print('OK sharded_queue_manager 1')
+    with q.session(None) as (conn, cur):
+        cur.execute("create schema if not exists shard_a; create schema if not exists shard_b;")
+        conn.commit()
+    dsns = dict(a=q.dsn + " options='-csearch_path=shard_a'", b=q.dsn + " options='-csearch_path=shard_b'")
+    sq = q4pg.ShardedQueueManager(dsns, table_name=gettable())
+    sq.create_table()
+    try:
+        tags = ['tag%d' % i for i in range(20)]
+        ids = sq.enqueue_many([(tag, tag) for tag in tags])
+        if ([sq.shard(tag).count(tag) for tag in tags] != [1] * 20 or sq.count('tag0') != 1 or
+            len([t for t in tags if sq.shard(t) is sq.shards['a']]) in (0, 20) or
+            [sq.shard(tag).list(tag)[0][0] for tag in tags] != ids):
+            raise Exception("failed sharded_queue_manager 2")
+        for tag in tags:
+            with sq.dequeue(tag) as res:
+                if res != tag:
+                    raise Exception("failed sharded_queue_manager 2")
+        print('OK sharded_queue_manager 2')
+        # routed by the message keys, the tag spans both shards.
+        key = dict((name, [k for k in keys if sq.ring.node(k) == name][0]) for name in ('a', 'b'))
+        for i in range(5):
+            sq.enqueue('tag', {'shard': 'a', 'i': i}, key=key['a'])
+        for i in range(2):
+            sq.enqueue('tag', {'shard': 'b', 'i': i}, key=key['b'])
+        ids = sq.enqueue_many([('tag', {'shard': 'a', 'i': 5}, None, None, None, key['a']),
+                               ('tag', {'shard': 'b', 'i': 2}, None, None, None, key['b'])])
+        if [sq.shards[name].list('tag')[-1][0] for name in ('a', 'b')] != ids:
+            raise Exception("failed sharded_queue_manager 3 " + str(ids))
+        stats = sq.stats(['tag'])
+        if (sq.shards['a'].count('tag'), sq.shards['b'].count('tag')) != (6, 3) or stats['tag']['ready'] != 9 or stats['tag']['total'] != 9:
+            raise Exception("failed sharded_queue_manager 3 " + str(stats))
+        print('OK sharded_queue_manager 3')
+        res = []
+        for dq in sq.listen('tag', timeout=1):
+            if dq is None:
+                break
+            res.append(dq['shard'])
+        if res != ['a', 'b', 'a', 'b', 'a', 'b', 'a', 'a', 'a'] or sq.count('tag') != 0: # in turn while both have backlog.
+            raise Exception("failed sharded_queue_manager 4 " + str(res))
+        print('OK sharded_queue_manager 4')
+        def enqueue_later():
+            time.sleep(0.5)
+            sq.enqueue('tag', {'shard': 'b', 'sent': time.time()}, key=key['b'])
+        t = threading.Thread(target=enqueue_later)
+        t.start()
+        res = []
+        for dq in sq.listen('tag', timeout=5): # waken by a notification of any shard.
+            res.append((dq, time.time()))
+            break
+        t.join()
+        if len(res) != 1 or res[0][0] is None or 0.5 < res[0][1] - res[0][0]['sent']:
+            raise Exception("failed sharded_queue_manager 5 " + str(res))
+        print('OK sharded_queue_manager 5')
+        # an ignored queue does not end the backlog of its shard.
+        for m in sq.shards.values():
+            m.excepted_times_to_ignore = 1
+        ids = [sq.enqueue('tag', {'i': i}, key=key['a']) for i in range(2)]
+        with sq.shards['a'].session(None) as (conn, cur):
+            cur.execute("update %s set except_times = 1 where id = %%s;" % sq.shards['a'].table_name, (ids[0],))
+            conn.commit()
+        res = []
+        for dq in sq.listen('tag', timeout=1):
+            res.append(dq)
+            break
+        if res != [{'i': 1}] or [r[0] for r in sq.shards['a'].list('tag')] != ids[1:]: # reported by the break.
+            raise Exception("failed sharded_queue_manager 6 " + str(res))
+        print('OK sharded_queue_manager 6')
+    finally:
+        sq.drop_table()
+        sq.close()
+
+def concurrency_limits():
+    for claim_strategy in q4pg.QueueManager.CLAIM_STRATEGIES:
+        cq = q4pg.QueueManager(q.dsn, table_name=gettable(), claim_strategy=claim_strategy, concurrency_limits=True)
+        cq.create_table()
+        try:
+            cq.set_concurrency_limit('tag', 2)
+            cq.enqueue_many([('tag', i) for i in range(5)] + [('free', i) for i in range(3)])
+            with cq.dequeue('tag') as a:
+                with cq.dequeue('tag') as b:
+                    with cq.dequeue('tag') as c: # limited, while the others are handled.
+                        with cq.dequeue_batch('free', 3) as free:
+                            if (a, b, c) != (0, 1, None) or free != [0, 1, 2] or cq.dequeue_immediate('tag') != None:
+                                raise Exception("failed concurrency_limits 1")
+                with cq.dequeue_batch('tag', 5) as res:
+                    if res != [2]:
+                        raise Exception("failed concurrency_limits 1 " + str(res))
+            if cq.count('tag') != 2 or cq.get_metrics()['counters']['claims_limited'] < 3:
+                raise Exception("failed concurrency_limits 1")
+            print('OK concurrency_limits 1')
+            cq.enqueue_many([('tag', i) for i in range(10)])
+            lock, running, peak, done = threading.Lock(), [0], [0], []
+            def handler(dq):
+                with lock:
+                    running[0] += 1
+                    peak[0] = max(peak[0], running[0])
+                time.sleep(0.05)
+                with lock:
+                    running[0] -= 1
+                    done.append(dq)
+            w = q4pg.Worker(cq, 'tag', handler, concurrency=6)
+            t = threading.Thread(target=w.run)
+            start = time.time()
+            t.start()
+            while len(done) < 12 and t.is_alive() and time.time() - start < 10:
+                time.sleep(0.05)
+            w.stop()
+            t.join()
+            # waiting consumers are waken by the acks, not by the rescan.
+            if len(done) != 12 or peak[0] != 2 or 5 < time.time() - start:
+                raise Exception("failed concurrency_limits 2 " + str((len(done), peak[0], time.time() - start)))
+            print('OK concurrency_limits 2')
+            cq.set_concurrency_limit('tag', None)
+            cq.set_concurrency_limit('free', 0) # paused.
+            cq.enqueue('free', 0)
+            if cq.get_concurrency_limits() != {'free': 0} or cq.dequeue_immediate('free') != None:
+                raise Exception("failed concurrency_limits 3")
+            print('OK concurrency_limits 3')
+            cq.set_concurrency_limit('tag', 3)
+            cq.enqueue('tag', 0)
+            with cq.dequeue_batch('tag', 3) as a: # fewer queues than its size, takes a slot only.
+                cq.enqueue('tag', 1)
+                with cq.dequeue('tag') as b:
+                    cq.enqueue_many([('tag', 2), ('tag', 3)])
+                    with cq.dequeue_batch('tag', 3) as c: # more queues than the free slot, claimed again.
+                        if (a, b, c) != ([0], 1, [2]) or cq.count('tag') != 1:
+                            raise Exception("failed concurrency_limits 4 " + str((a, b, c)))
+            print('OK concurrency_limits 4')
+        finally:
+            cq.drop_table()
+            cq.close()
+    for k in (-1, 1.5):
+        try:
+            q4pg.QueueManager(q.dsn, concurrency_limits=True).set_concurrency_limit('tag', k)
+            raise Exception("failed concurrency_limits 5")
+        except ValueError:
+            pass
+    try:
+        q.set_concurrency_limit('tag', 1)
+        raise Exception("failed concurrency_limits 5")
+    except ValueError:
+        print('OK concurrency_limits 5')
+
 def test_multiprocess_tasks():
     wait_until_convenient()
     TAG = "message_q"
@@ -464,6 +1524,30 @@ def main():
         dangerous_data_sanitizing()
         scheduling()
         enqueue2()
+        connection_pool()
+        enqueue_many()
+        dequeue_batch()
+        skip_locked_strategy()
+        persistent_listener()
+        listen_many()
+        async_queue_manager()
+        worker()
+        stats()
+        iter_items()
+        serializers()
+        scheduled_delivery()
+        metrics()
+        partitions()
+        prepared_statements()
+        dead_letter()
+        notify_payloads()
+        shared_manager()
+        priorities()
+        lease()
+        dedup_keys()
+        single_round_trip_enqueue()
+        sharded_queue_manager()
+        concurrency_limits()
         test_multiprocess_tasks()
     except:
         raise